@@ -1,28 +1,97 @@
 import json
-import urllib.request
+import http.client
+import urllib.parse
 import csv
 import os
 import html
 import re
 import unicodedata
+import functools
+import operator
 import sys
-import base64
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # Décodage base64 vectorisé (SIMD) si pybase64 est installé
+    from pybase64 import b64decode as _b64decode
+except ImportError:
+    from binascii import a2b_base64 as _b64decode
+
+try:
+    # Sérialisation JSON en C, plus rapide et moins gourmande si orjson est installé
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+    
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
 
 
 ANKI_URL = "http://127.0.0.1:8765"
 
+# Nombre d'appels simultanés à AnkiConnect (reste raisonnable pour le serveur)
+MEDIA_WORKERS = 8
+
+# Nombre de médias demandés par appel "multi" à AnkiConnect
+MEDIA_BATCH_SIZE = 50
+
+# Format des CSV exportés, enregistré une seule fois : chaque csv.writer
+# réutilise ce dialecte au lieu d'en reconstruire un à partir d'arguments
+CSV_DIALECT = "anki_companion"
+csv.register_dialect(CSV_DIALECT, delimiter=";", quoting=csv.QUOTE_MINIMAL)
+
+# Nombre de notes demandées par appel notesInfo
+NOTES_CHUNK_SIZE = 500
+
+# Tampon d'écriture des CSV : quelques gros write() plutôt qu'un par bloc de 8 Ko
+CSV_BUFFER_SIZE = 1024 * 1024
+
+# Taille des tranches base64 décodées à la fois (multiple de 4)
+B64_CHUNK_SIZE = 64 * 1024
+
+# Ouverture des fichiers médias (O_BINARY n'existe que sous Windows)
+MEDIA_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+IMAGE_RE = re.compile(r'src=(["\'])([^"\']+\.(?:jpg|jpeg|png|gif|svg|webp))\1', re.IGNORECASE)
+
+# Caractères ASCII supprimés par slugify (tout sauf [\w\s-])
+_SLUG_DROP = str.maketrans("", "", "".join(
+    c for c in map(chr, range(128)) if not (c.isalnum() or c.isspace() or c in "_-")
+))
+_SLUG_SEP_RE = re.compile(r'[-\s]+')
+
+_anki_address = urllib.parse.urlsplit(ANKI_URL)
+
+
+def _post(payload):
+    """
+    Envoie un corps JSON à AnkiConnect et décode la réponse. AnkiConnect
+    ferme la connexion après chaque réponse : une connexion par appel.
+    """
+    conn = http.client.HTTPConnection(_anki_address.hostname, _anki_address.port)
+    try:
+        conn.request("POST", _anki_address.path or "/", body=payload,
+                     headers={"Content-Type": "application/json"})
+        return _json_loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
 
 def request(action, **params):
     """Communique avec AnkiConnect."""
+    return request_payload(_json_dumps({
+        "action": action,
+        "params": params,
+        "version": 6
+    }))
+
+
+def request_payload(payload):
+    """Comme request(), pour un corps JSON déjà sérialisé."""
     try:
-        response = json.load(urllib.request.urlopen(urllib.request.Request(
-            ANKI_URL,
-            json.dumps({
-                "action": action,
-                "params": params,
-                "version": 6
-            }).encode("utf-8")
-        )))
+        response = _post(payload)
         if response.get("error") is not None:
             raise Exception(response["error"])
         return response
@@ -31,82 +100,224 @@ def request(action, **params):
         return None
 
 
+# Valeur d'un champ de note tel que renvoyé par notesInfo
+_FIELD_VALUE = operator.itemgetter("value")
+
+# Enveloppes JSON pré-sérialisées des requêtes les plus fréquentes : seuls
+# les noms de fichiers / identifiants de notes sont encodés à chaque appel
+_MULTI_PREFIX = b'{"action": "multi", "version": 6, "params": {"actions": ['
+_MEDIA_ACTION_PREFIX = b'{"action": "retrieveMediaFile", "version": 6, "params": {"filename": '
+_NOTES_INFO_PREFIX = b'{"action": "notesInfo", "version": 6, "params": {"notes": ['
+
+
+def media_batch_payload(filenames):
+    """Corps d'un appel "multi" de retrieveMediaFile pour chaque fichier."""
+    return _MULTI_PREFIX + b",".join(
+        _MEDIA_ACTION_PREFIX + _json_dumps(filename) + b"}}"
+        for filename in filenames
+    ) + b"]}}"
+
+
+def notes_info_payload(note_ids):
+    """Corps d'un appel notesInfo pour une liste d'identifiants de notes."""
+    return _NOTES_INFO_PREFIX + ",".join(map(str, note_ids)).encode("ascii") + b"]}}"
+
+
+@functools.lru_cache(maxsize=None)
 def slugify(value):
     """Supprime accents et caractères spéciaux."""
-    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
-    value = re.sub(r'[^\w\s-]', '', value).strip().lower()
-    return re.sub(r'[-\s]+', '_', value)
+    # Le passage par NFKD n'est utile que pour les caractères non ASCII
+    if not value.isascii():
+        value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
+    value = value.translate(_SLUG_DROP).strip().lower()
+    return _SLUG_SEP_RE.sub('_', value)
 
 
-def retrieve_media_from_anki(filename, media_subfolder, media_base_dir):
+def save_media_file(filename, encoded, target_dir):
     """
-    Récupère un fichier média depuis Anki via AnkiConnect (base64)
-    et l'enregistre dans le dossier local.
+    Décode un média base64 renvoyé par AnkiConnect et l'enregistre.
+    Le décodage se fait par tranches écrites au fil de l'eau, pour ne
+    jamais garder tout le fichier décodé en mémoire.
     """
-    target_dir = os.path.join(media_base_dir, media_subfolder)
-    os.makedirs(target_dir, exist_ok=True)
-    
     target_path = os.path.join(target_dir, filename)
-    
-    # Si le fichier existe déjà, on ne le re-télécharge pas
-    if os.path.exists(target_path):
-        return True
-    
-    # Appel AnkiConnect pour récupérer le fichier en base64
-    response = request("retrieveMediaFile", filename=filename)
-    
-    if not response or not response.get("result"):
-        print(f"  ⚠️  Média introuvable dans Anki : {filename}")
-        return False
-    
     try:
-        # Décoder le base64 et écrire le fichier
-        file_data = base64.b64decode(response["result"])
-        with open(target_path, 'wb') as f:
-            f.write(file_data)
+        # Descripteur brut : une écriture directe par tranche, sans objet fichier
+        fd = os.open(target_path, MEDIA_OPEN_FLAGS, 0o644)
+        try:
+            for start in range(0, len(encoded), B64_CHUNK_SIZE):
+                data = memoryview(_b64decode(encoded[start:start + B64_CHUNK_SIZE]))
+                while data:
+                    data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
         print(f"  📸 {filename}")
         return True
     except Exception as e:
         print(f"  ⚠️  Erreur sauvegarde {filename}: {e}")
+        # Un fichier partiel serait pris pour un média déjà téléchargé
+        try:
+            os.remove(target_path)
+        except OSError:
+            pass
         return False
 
 
-def process_media_in_text(source_text, media_subfolder, media_base_dir):
+def retrieve_media_from_anki(filenames, media_subfolder, media_base_dir):
     """
-    Cherche les images dans le texte HTML, les télécharge via AnkiConnect,
-    et modifie les chemins pour pointer vers ../media/dossier/image.jpg
+    Récupère un lot de fichiers médias depuis Anki en un seul appel
+    (action "multi" d'AnkiConnect, base64) et les enregistre dans le dossier local.
     """
-    modified_text = source_text
-    image_pattern = r'src=["\']([^"\']+\.(jpg|jpeg|png|gif|svg|webp))["\']'
-    matches = re.findall(image_pattern, source_text, re.IGNORECASE)
+    target_dir = os.path.join(media_base_dir, media_subfolder)
     
-    for match in matches:
-        filename = match[0]
-        
-        # Télécharger l'image via AnkiConnect
-        retrieve_media_from_anki(filename, media_subfolder, media_base_dir)
-        
-        # Remplacer le chemin dans le HTML
-        new_relative_path = f"../media/{media_subfolder}/{filename}"
-        modified_text = modified_text.replace(f'src="{filename}"', f'src="{new_relative_path}"')
-        modified_text = modified_text.replace(f"src='{filename}'", f"src='{new_relative_path}'")
+    response = request_payload(media_batch_payload(filenames))
+    if not response:
+        return 0
+    
+    results = response["result"]
+    del response
     
-    return modified_text
+    saved = 0
+    for i, filename in enumerate(filenames):
+        # Retire la chaîne base64 de la liste : elle est libérée dès l'écriture faite
+        result, results[i] = results[i], None
+        if result.get("error") is not None or not result.get("result"):
+            print(f"  ⚠️  Média introuvable dans Anki : {filename}")
+            continue
+        saved += save_media_file(filename, result["result"], target_dir)
+    return saved
 
 
-def export_deck(deck_name, output_base_dir, media_base_dir):
-    """Exporte un deck vers CSV avec ses médias."""
-    print(f"📦 {deck_name}")
+def download_media(filenames, media_subfolder, media_base_dir, executor):
+    """
+    Lance le téléchargement d'une liste de médias via AnkiConnect, par lots
+    de MEDIA_BATCH_SIZE, sur le pool de threads de l'export.
+    Renvoie les futures correspondantes (voir wait_media).
+    """
+    return [
+        executor.submit(retrieve_media_from_anki, filenames[i:i + MEDIA_BATCH_SIZE], media_subfolder, media_base_dir)
+        for i in range(0, len(filenames), MEDIA_BATCH_SIZE)
+    ]
+
+
+def wait_media(futures):
+    """Attend la fin des téléchargements lancés par download_media."""
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"  ⚠️  Erreur téléchargement médias : {e}")
+
+
+def process_media_in_text(source_text, media_subfolder, on_media=None):
+    """
+    Modifie les chemins des images du texte HTML pour pointer
+    vers ../media/dossier/image.jpg (les fichiers sont téléchargés à part).
+    on_media, s'il est fourni, est appelé avec le nom de chaque image
+    rencontrée : recensement et réécriture se font dans la même passe.
+    """
+    def rewrite(match):
+        quote, filename = match.group(1), match.group(2)
+        if on_media is not None:
+            on_media(filename)
+        return f"src={quote}../media/{media_subfolder}/{filename}{quote}"
     
-    media_subfolder = slugify(deck_name.split("::")[-1])
+    return IMAGE_RE.sub(rewrite, source_text)
+
+
+def convert_notes(notes, media_subfolder):
+    """
+    Convertit un paquet de notes en lignes CSV : HTML décodé, chemins
+    d'images réécrits, tags en dernière colonne. Renvoie (lignes, noms des
+    images rencontrées).
+    """
+    found_media = []
+    unescape = html.unescape
+    rewrite_media = process_media_in_text
+    field_value = _FIELD_VALUE
     
+    def convert_field(value):
+        if "&" in value:
+            value = unescape(value)
+        if "=" in value:
+            value = rewrite_media(value, media_subfolder, found_media.append)
+        return value
+    
+    # Les valeurs sont extraites côté C (map + itemgetter) ; un champ sans
+    # "&" ni "=" (texte brut, ni entité ni attribut src=...) est repris
+    # tel quel, sans appel de fonction Python
+    rows = [
+        [value if "&" not in value and "=" not in value else convert_field(value)
+         for value in map(field_value, note["fields"].values())]
+        + [" ".join(note["tags"])]
+        for note in notes
+    ]
+    return rows, list(dict.fromkeys(found_media))
+
+
+def fetch_deck_start(deck_name):
+    """
+    Récupère les identifiants des notes d'un deck puis leur premier paquet
+    (voir iter_notes_info). Renvoie (note_ids, réponse notesInfo), avec
+    None pour chaque appel ayant échoué.
+    """
     find_notes = request("findNotes", query=f'"deck:{deck_name}"')
     if not find_notes:
+        return None, None
+    note_ids = find_notes["result"]
+    if not note_ids:
+        return note_ids, None
+    return note_ids, request_payload(notes_info_payload(note_ids[:NOTES_CHUNK_SIZE]))
+
+
+def iter_deck_starts(deck_names, executor):
+    """
+    Associe à chaque deck la future de son fetch_deck_start. Celui du deck
+    suivant est lancé avant de rendre la main : ses notes sont récupérées
+    pendant que le deck courant est écrit.
+    """
+    upcoming = executor.submit(fetch_deck_start, deck_names[0]) if deck_names else None
+    for i, deck_name in enumerate(deck_names):
+        current = upcoming
+        if i + 1 < len(deck_names):
+            upcoming = executor.submit(fetch_deck_start, deck_names[i + 1])
+        yield deck_name, current
+
+
+def iter_notes_info(note_ids, first_response, executor):
+    """
+    Récupère les notes par paquets de NOTES_CHUNK_SIZE plutôt qu'en une
+    seule énorme réponse. Le premier paquet est fourni (fetch_deck_start),
+    le suivant est demandé à AnkiConnect pendant que le courant est traité.
+    Renvoie None à la place d'un paquet dont la récupération a échoué.
+    """
+    chunks = [note_ids[i:i + NOTES_CHUNK_SIZE] for i in range(0, len(note_ids), NOTES_CHUNK_SIZE)]
+    
+    pending = None
+    for i in range(len(chunks)):
+        response = first_response if i == 0 else pending.result()
+        if i + 1 < len(chunks):
+            pending = executor.submit(request_payload, notes_info_payload(chunks[i + 1]))
+        yield response["result"] if response else None
+
+
+def export_deck(deck_name, deck_start, output_base_dir, media_base_dir, executor, known_media):
+    """
+    Exporte un deck vers CSV avec ses médias. Les appels AnkiConnect
+    (notes, médias) passent par le pool de threads partagé de l'export ;
+    deck_start est la future de fetch_deck_start pour ce deck.
+    known_media associe à chaque sous-dossier de médias l'ensemble des
+    fichiers déjà présents ou demandés pendant l'export : un média n'est
+    jamais demandé deux fois, et le disque n'est listé qu'une fois par dossier.
+    """
+    print(f"📦 {deck_name}")
+    
+    media_subfolder = slugify(deck_name.split("::")[-1])
+    
+    note_ids, first_notes = deck_start.result()
+    if note_ids is None:
         print("  ❌ findNotes échoué\n")
         return 0
-    
-    notes_info = request("notesInfo", notes=find_notes["result"])
-    if not notes_info:
+    if note_ids and first_notes is None:
         print("  ❌ notesInfo échoué\n")
         return 0
     
@@ -122,33 +333,64 @@ def export_deck(deck_name, output_base_dir, media_base_dir):
     os.makedirs(matiere_dir, exist_ok=True)
     
     csv_path = os.path.join(matiere_dir, f"{safe_filename}.csv")
+    # Écrit à côté puis renommé : un export interrompu laisse l'ancien CSV intact
+    tmp_path = csv_path + ".tmp"
+    
+    media_dir = os.path.join(media_base_dir, media_subfolder)
+    media_futures = []
+    
+    # Un seul listing du dossier au lieu d'un os.path.exists par image
+    deck_media = known_media.get(media_subfolder)
+    if deck_media is None:
+        try:
+            deck_media = set(os.listdir(media_dir))
+        except FileNotFoundError:
+            deck_media = set()
+        known_media[media_subfolder] = deck_media
     
     try:
-        with open(csv_path, "w", encoding="utf-8-sig", newline="") as f:
-            writer = csv.writer(f, delimiter=";", quoting=csv.QUOTE_MINIMAL)
+        with open(tmp_path, "w", encoding="utf-8-sig", newline="", buffering=CSV_BUFFER_SIZE) as f:
+            writer = csv.writer(f, CSV_DIALECT)
+            
+            def write_chunk(rows, found_media):
+                """Écrit un paquet converti et lance le téléchargement de ses nouvelles images."""
+                writer.writerows(rows)
+                # Les chemins réécrits ne dépendent pas du téléchargement : les
+                # médias du paquet sont récupérés pendant l'écriture des suivants
+                new_media = []
+                for filename in found_media:
+                    if filename in deck_media:
+                        continue
+                    deck_media.add(filename)
+                    # Absent du listing : le système de fichiers tranche selon ses
+                    # propres règles (casse, forme Unicode des noms sous macOS)
+                    if not os.path.exists(os.path.join(media_dir, filename)):
+                        new_media.append(filename)
+                if new_media:
+                    os.makedirs(media_dir, exist_ok=True)
+                    media_futures.extend(download_media(new_media, media_subfolder, media_base_dir, executor))
+                return len(rows)
             
             count = 0
-            for note in notes_info["result"]:
-                fields_values = []
-                
-                for field_obj in note["fields"].values():
-                    raw_value = field_obj["value"]
-                    clean_value = html.unescape(raw_value)
-                    # ⬇️ NOUVEAU : télécharge les images via AnkiConnect
-                    modified_value = process_media_in_text(clean_value, media_subfolder, media_base_dir)
-                    fields_values.append(modified_value)
-                
-                tags = " ".join(note["tags"])
-                fields_values.append(tags)
-                
-                writer.writerow(fields_values)
-                count += 1
+            for notes in iter_notes_info(note_ids, first_notes, executor):
+                if notes is None:
+                    raise Exception("notesInfo échoué")
+                # Conversion sur place : ~5 ms par paquet de 500 notes, dont la
+                # moitié partirait en pickle vers un processus de conversion
+                count += write_chunk(*convert_notes(notes, media_subfolder))
+        
+        wait_media(media_futures)
+        os.replace(tmp_path, csv_path)
         
         print(f"✅ {count} cartes\n")
         return count
         
     except Exception as e:
-        print(f"❌ Erreur écriture : {e}\n")
+        print(f"❌ Erreur export : {e}\n")
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
         return 0
 
 
@@ -204,8 +446,10 @@ def main():
     print(f"Export de {len(target_decks)} deck(s)...\n")
     
     total = 0
-    for deck in target_decks:
-        total += export_deck(deck, output_dir, media_dir)
+    known_media = {}
+    with ThreadPoolExecutor(max_workers=MEDIA_WORKERS) as executor:
+        for deck, deck_start in iter_deck_starts(target_decks, executor):
+            total += export_deck(deck, deck_start, output_dir, media_dir, executor, known_media)
     
     print(f"✅ TERMINÉ : {total} cartes exportées")
 
@@ -6,39 +6,133 @@ Anki must be running with AnkiConnect add-on active.
 """
 
 import json
-import urllib.request
+import http.client
+import urllib.parse
 import csv
 import os
 import html
 import re
 import unicodedata
-import base64
+import functools
+import operator
 import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 
+try:
+    # SIMD-accelerated base64 decoding when pybase64 is installed
+    from pybase64 import b64decode as _b64decode
+except ImportError:
+    from binascii import a2b_base64 as _b64decode
+
+try:
+    # Faster JSON (de)serialization with less transient garbage when orjson is installed
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
 ANKI_URL = "http://127.0.0.1:8765"
 APP_TITLE = "Anki Companion"
 
+# Interval at which queued log messages are flushed to the output widget
+LOG_FLUSH_MS = 50
+
+# Concurrent AnkiConnect calls (kept modest to stay polite to the server)
+MEDIA_WORKERS = 8
+
+# Media files requested per AnkiConnect "multi" call
+MEDIA_BATCH_SIZE = 50
+
+# Exported CSV format, registered once: each csv.writer reuses this
+# dialect instead of building a new one from keyword arguments
+CSV_DIALECT = "anki_companion"
+csv.register_dialect(CSV_DIALECT, delimiter=";", quoting=csv.QUOTE_MINIMAL)
+
+# Notes requested per notesInfo call
+NOTES_CHUNK_SIZE = 500
+
+# CSV write buffer: a few large write() calls instead of one per 8 KiB
+CSV_BUFFER_SIZE = 1024 * 1024
+
+# Base64 slice decoded at a time (must stay a multiple of 4)
+B64_CHUNK_SIZE = 64 * 1024
+
+# Media file open flags (O_BINARY only exists on Windows)
+MEDIA_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+
+IMAGE_RE = re.compile(r'src=(["\'])([^"\']+\.(?:jpg|jpeg|png|gif|svg|webp))\1', re.IGNORECASE)
+
+# ASCII characters removed by slugify (anything but [\w\s-])
+_SLUG_DROP = str.maketrans("", "", "".join(
+    c for c in map(chr, range(128)) if not (c.isalnum() or c.isspace() or c in "_-")
+))
+_SLUG_SEP_RE = re.compile(r'[-\s]+')
+
+_anki_address = urllib.parse.urlsplit(ANKI_URL)
+
+
+def _post(payload):
+    """
+    POST a JSON body to AnkiConnect and decode the reply. AnkiConnect closes
+    the socket after every response, so each call opens its own connection.
+    """
+    conn = http.client.HTTPConnection(_anki_address.hostname, _anki_address.port)
+    try:
+        conn.request("POST", _anki_address.path or "/", body=payload,
+                     headers={"Content-Type": "application/json"})
+        return _json_loads(conn.getresponse().read())
+    finally:
+        conn.close()
 
-# ──────────────────────────────────────────────
-# AnkiConnect helpers
-# ──────────────────────────────────────────────
 
 def anki_request(action, **params):
     """Send a request to AnkiConnect and return the result."""
-    payload = json.dumps({
+    payload = _json_dumps({
         "action": action,
         "params": params,
         "version": 6
-    }).encode("utf-8")
-    req = urllib.request.Request(ANKI_URL, payload)
-    response = json.load(urllib.request.urlopen(req))
+    })
+    return anki_request_payload(payload)
+
+
+def anki_request_payload(payload):
+    """Like anki_request(), for an already serialized JSON body."""
+    response = _post(payload)
     if response.get("error") is not None:
         raise Exception(response["error"])
     return response["result"]
 
 
+# Value of a note field as returned by notesInfo
+_FIELD_VALUE = operator.itemgetter("value")
+
+# Pre-serialized JSON envelopes for the hot requests: only the filenames /
+# note ids are encoded on each call
+_MULTI_PREFIX = b'{"action": "multi", "version": 6, "params": {"actions": ['
+_MEDIA_ACTION_PREFIX = b'{"action": "retrieveMediaFile", "version": 6, "params": {"filename": '
+_NOTES_INFO_PREFIX = b'{"action": "notesInfo", "version": 6, "params": {"notes": ['
+
+
+def media_batch_payload(filenames):
+    """Body of a "multi" call running retrieveMediaFile for each file."""
+    return _MULTI_PREFIX + b",".join(
+        _MEDIA_ACTION_PREFIX + _json_dumps(filename) + b"}}"
+        for filename in filenames
+    ) + b"]}}"
+
+
+def notes_info_payload(note_ids):
+    """Body of a notesInfo call for a list of note ids."""
+    return _NOTES_INFO_PREFIX + ",".join(map(str, note_ids)).encode("ascii") + b"]}}"
+
+
 def fetch_deck_names():
     """Get list of deck names from Anki."""
     return anki_request("deckNames")
@@ -48,74 +142,176 @@ def fetch_deck_names():
 # Export logic (same as export_with_media.py)
 # ──────────────────────────────────────────────
 
+@functools.lru_cache(maxsize=None)
 def slugify(value):
-    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
-    value = re.sub(r'[^\w\s-]', '', value).strip().lower()
-    return re.sub(r'[-\s]+', '_', value)
+    if not value.isascii():
+        value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
+    value = value.translate(_SLUG_DROP).strip().lower()
+    return _SLUG_SEP_RE.sub('_', value)
 
 
-def retrieve_media_from_anki(filename, media_subfolder, media_base_dir):
-    target_dir = os.path.join(media_base_dir, media_subfolder)
-    os.makedirs(target_dir, exist_ok=True)
+def save_media_file(filename, encoded, target_dir):
+    """Decode base64 media straight into the target file, one slice at a time."""
     target_path = os.path.join(target_dir, filename)
-
-    if os.path.exists(target_path):
-        return True
-
-    try:
-        result = anki_request("retrieveMediaFile", filename=filename)
-    except Exception:
-        return False
-
-    if not result:
-        return False
-
     try:
-        file_data = base64.b64decode(result)
-        with open(target_path, 'wb') as f:
-            f.write(file_data)
+        # Raw descriptor: one direct write per slice, no buffered file object
+        fd = os.open(target_path, MEDIA_OPEN_FLAGS, 0o644)
+        try:
+            for start in range(0, len(encoded), B64_CHUNK_SIZE):
+                data = memoryview(_b64decode(encoded[start:start + B64_CHUNK_SIZE]))
+                while data:
+                    data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
         return True
     except Exception:
+        # A partial file would later be mistaken for an already downloaded one
+        try:
+            os.remove(target_path)
+        except OSError:
+            pass
         return False
 
 
-def process_media_in_text(source_text, media_subfolder, media_base_dir):
-    modified_text = source_text
-    image_pattern = r'src=["\']([^"\']+\.(jpg|jpeg|png|gif|svg|webp))["\']'
-    matches = re.findall(image_pattern, source_text, re.IGNORECASE)
-
-    for match in matches:
-        filename = match[0]
-        retrieve_media_from_anki(filename, media_subfolder, media_base_dir)
-        new_relative_path = f"../media/{media_subfolder}/{filename}"
-        modified_text = modified_text.replace(f'src="{filename}"', f'src="{new_relative_path}"')
-        modified_text = modified_text.replace(f"src='{filename}'", f"src='{new_relative_path}'")
-
-    return modified_text
+def retrieve_media_from_anki(filenames, media_subfolder, media_base_dir):
+    """Fetch a batch of media files in one AnkiConnect "multi" call and save them."""
+    target_dir = os.path.join(media_base_dir, media_subfolder)
 
+    try:
+        results = anki_request_payload(media_batch_payload(filenames))
+    except Exception:
+        return 0
 
-def export_deck(deck_name, output_base_dir, media_base_dir, log_fn=print):
-    """Export a single deck to CSV with media. Returns card count."""
+    saved = 0
+    for i, filename in enumerate(filenames):
+        # Drop each base64 string from the list so it is freed once written
+        result, results[i] = results[i], None
+        if result.get("error") is not None or not result.get("result"):
+            continue
+        saved += save_media_file(filename, result["result"], target_dir)
+    return saved
+
+
+def download_media(filenames, media_subfolder, media_base_dir, executor):
+    """Queue media downloads in MEDIA_BATCH_SIZE batches on the export's thread pool."""
+    return [
+        executor.submit(retrieve_media_from_anki, filenames[i:i + MEDIA_BATCH_SIZE], media_subfolder, media_base_dir)
+        for i in range(0, len(filenames), MEDIA_BATCH_SIZE)
+    ]
+
+
+def wait_media(futures):
+    for future in futures:
+        try:
+            future.result()
+        except Exception:
+            pass
+
+
+def process_media_in_text(source_text, media_subfolder, on_media=None):
+    """
+    Point image paths to ../media/<subfolder>/, in a single regex pass.
+    on_media, if given, is called with each image filename found.
+    """
+    def rewrite(match):
+        quote, filename = match.group(1), match.group(2)
+        if on_media is not None:
+            on_media(filename)
+        return f"src={quote}../media/{media_subfolder}/{filename}{quote}"
+
+    return IMAGE_RE.sub(rewrite, source_text)
+
+
+def convert_notes(notes, media_subfolder):
+    """
+    Convert a chunk of notes to CSV rows (unescaped HTML, rewritten image
+    paths, tags last). Returns (rows, image filenames found).
+    """
+    found_media = []
+    unescape = html.unescape
+    rewrite_media = process_media_in_text
+    field_value = _FIELD_VALUE
+
+    def convert_field(value):
+        if "&" in value:
+            value = unescape(value)
+        if "=" in value:
+            value = rewrite_media(value, media_subfolder, found_media.append)
+        return value
+
+    # Values are pulled out in C (map + itemgetter); a field with neither "&"
+    # nor "=" (plain text: no entity, no src=... attribute) is kept as is,
+    # without a Python function call
+    rows = [
+        [value if "&" not in value and "=" not in value else convert_field(value)
+         for value in map(field_value, note["fields"].values())]
+        + [" ".join(note["tags"])]
+        for note in notes
+    ]
+    return rows, list(dict.fromkeys(found_media))
+
+
+def fetch_deck_start(deck_name):
+    """Return a deck's note ids and its first notesInfo chunk (see iter_notes_info)."""
+    note_ids = anki_request("findNotes", query=f'"deck:{deck_name}"')
+    if not note_ids:
+        return note_ids, None
+    return note_ids, anki_request_payload(notes_info_payload(note_ids[:NOTES_CHUNK_SIZE]))
+
+
+def iter_deck_starts(deck_names, executor):
+    """
+    Pair each deck with a future of its fetch_deck_start. The next deck's
+    fetch is submitted first, so its notes download while this one is written.
+    """
+    upcoming = executor.submit(fetch_deck_start, deck_names[0]) if deck_names else None
+    for i, deck_name in enumerate(deck_names):
+        current = upcoming
+        if i + 1 < len(deck_names):
+            upcoming = executor.submit(fetch_deck_start, deck_names[i + 1])
+        yield deck_name, current
+
+
+def iter_notes_info(note_ids, first_notes, executor):
+    """
+    Yield notes in NOTES_CHUNK_SIZE chunks instead of one huge response.
+    The first chunk is given (fetch_deck_start); each following chunk is
+    fetched while the previous one is being processed.
+    """
+    chunks = [note_ids[i:i + NOTES_CHUNK_SIZE] for i in range(0, len(note_ids), NOTES_CHUNK_SIZE)]
+
+    pending = None
+    for i in range(len(chunks)):
+        notes = first_notes if i == 0 else pending.result()
+        if i + 1 < len(chunks):
+            pending = executor.submit(anki_request_payload, notes_info_payload(chunks[i + 1]))
+        yield notes
+
+
+def export_deck(deck_name, deck_start, output_base_dir, media_base_dir, executor, known_media,
+                log_fn=print):
+    """
+    Export a single deck to CSV with media. Returns card count.
+    AnkiConnect calls (notes, media) run on the export's shared thread pool;
+    deck_start is the future of this deck's fetch_deck_start.
+    known_media maps each media subfolder to the files already on disk or
+    requested during this export: a media file is never requested twice and
+    each folder is listed only once.
+    """
     log_fn(f"📦 {deck_name}")
 
     media_subfolder = slugify(deck_name.split("::")[-1])
 
     try:
-        note_ids = anki_request("findNotes", query=f'"deck:{deck_name}"')
+        note_ids, first_notes = deck_start.result()
     except Exception as e:
-        log_fn(f"  ❌ findNotes failed: {e}")
+        log_fn(f"  ❌ Fetching notes failed: {e}")
         return 0
 
     if not note_ids:
         log_fn(f"  ⚠️ No notes found")
         return 0
 
-    try:
-        notes_info = anki_request("notesInfo", notes=note_ids)
-    except Exception as e:
-        log_fn(f"  ❌ notesInfo failed: {e}")
-        return 0
-
     parts = deck_name.split("::")
     if len(parts) == 1:
         matiere = "divers"
@@ -128,27 +324,60 @@ def export_deck(deck_name, output_base_dir, media_base_dir, log_fn=print):
     os.makedirs(matiere_dir, exist_ok=True)
 
     csv_path = os.path.join(matiere_dir, f"{safe_filename}.csv")
+    # Written alongside then renamed, so a failed export keeps the previous CSV
+    tmp_path = csv_path + ".tmp"
+
+    media_dir = os.path.join(media_base_dir, media_subfolder)
+    media_futures = []
+
+    # A single directory listing instead of an os.path.exists call per image
+    deck_media = known_media.get(media_subfolder)
+    if deck_media is None:
+        try:
+            deck_media = set(os.listdir(media_dir))
+        except FileNotFoundError:
+            deck_media = set()
+        known_media[media_subfolder] = deck_media
 
     try:
-        with open(csv_path, "w", encoding="utf-8-sig", newline="") as f:
-            writer = csv.writer(f, delimiter=";", quoting=csv.QUOTE_MINIMAL)
+        with open(tmp_path, "w", encoding="utf-8-sig", newline="", buffering=CSV_BUFFER_SIZE) as f:
+            writer = csv.writer(f, CSV_DIALECT)
+
+            def write_chunk(rows, found_media):
+                writer.writerows(rows)
+                # Rewritten paths don't depend on the download, so this chunk's
+                # media is fetched while the next chunks are written
+                new_media = []
+                for filename in found_media:
+                    if filename in deck_media:
+                        continue
+                    deck_media.add(filename)
+                    # Not in the listing: let the filesystem decide with its own
+                    # rules (case folding, Unicode normalization on macOS)
+                    if not os.path.exists(os.path.join(media_dir, filename)):
+                        new_media.append(filename)
+                if new_media:
+                    os.makedirs(media_dir, exist_ok=True)
+                    media_futures.extend(download_media(new_media, media_subfolder, media_base_dir, executor))
+                return len(rows)
+
             count = 0
-            for note in notes_info:
-                fields_values = []
-                for field_obj in note["fields"].values():
-                    raw_value = field_obj["value"]
-                    clean_value = html.unescape(raw_value)
-                    modified_value = process_media_in_text(clean_value, media_subfolder, media_base_dir)
-                    fields_values.append(modified_value)
-                tags = " ".join(note["tags"])
-                fields_values.append(tags)
-                writer.writerow(fields_values)
-                count += 1
+            for notes in iter_notes_info(note_ids, first_notes, executor):
+                # Converted inline: ~5 ms per 500-note chunk, half of which a
+                # worker process would spend on pickling the chunk and its rows
+                count += write_chunk(*convert_notes(notes, media_subfolder))
+
+        wait_media(media_futures)
+        os.replace(tmp_path, csv_path)
 
         log_fn(f"  ✅ {count} cards exported")
         return count
     except Exception as e:
-        log_fn(f"  ❌ Write error: {e}")
+        log_fn(f"  ❌ Export error: {e}")
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
         return 0
 
 
@@ -179,8 +408,10 @@ class CardsCompanionApp:
 
         self.deck_vars = []  # list of (deck_name, BooleanVar)
         self.is_running = False
+        self._log_queue = collections.deque()
 
         self._build_ui()
+        self._drain_log()
 
     def _build_ui(self):
         # ── Title ──
@@ -221,17 +452,22 @@ class CardsCompanionApp:
         self._log("Make sure Anki is running with AnkiConnect enabled.")
 
     def _log(self, message):
-        """Append a message to the output log (thread-safe)."""
-        def _append():
+        """Queue a message for the output log (thread-safe, see _drain_log)."""
+        self._log_queue.append(message)
+
+    def _drain_log(self):
+        """Flush queued log messages in one widget update, then reschedule."""
+        messages = []
+        while self._log_queue:
+            messages.append(self._log_queue.popleft())
+
+        if messages:
             self.log_text.configure(state="normal")
-            self.log_text.insert("end", message + "\n")
+            self.log_text.insert("end", "\n".join(messages) + "\n")
             self.log_text.see("end")
             self.log_text.configure(state="disabled")
 
-        if threading.current_thread() is threading.main_thread():
-            _append()
-        else:
-            self.root.after(0, _append)
+        self.root.after(LOG_FLUSH_MS, self._drain_log)
 
     def _set_running(self, running):
         self.is_running = running
@@ -348,8 +584,11 @@ class CardsCompanionApp:
 
             self._log(f"Exporting {len(selected_decks)} deck(s)…\n")
             total = 0
-            for deck in selected_decks:
-                total += export_deck(deck, output_dir, media_dir, log_fn=self._log)
+            known_media = {}
+            with ThreadPoolExecutor(max_workers=MEDIA_WORKERS) as executor:
+                for deck, deck_start in iter_deck_starts(selected_decks, executor):
+                    total += export_deck(deck, deck_start, output_dir, media_dir, executor, known_media,
+                                         log_fn=self._log)
 
             self._log(f"\n✅ DONE: {total} cards exported to {dest}")
             self._set_running(False)